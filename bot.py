@@ -4,12 +4,13 @@ TuneBot - Telegram 音乐下载与归档机器人
 """
 import os
 import logging
-import io
 import re
 import asyncio
 import tempfile
+import time
 from uuid import uuid4
 from pathlib import Path
+from typing import Optional
 
 from telegram import (
     Update,
@@ -41,6 +42,7 @@ from config import (
 from utils import (
     client,
     init_db,
+    close_db,
     format_song_caption,
     format_favorite_item,
     format_history_item,
@@ -51,6 +53,7 @@ from utils import (
     add_favorite,
     remove_favorite,
     is_favorite,
+    favorites_lookup,
     get_favorites,
     get_favorites_count,
     add_history,
@@ -58,6 +61,8 @@ from utils import (
     get_history_count,
     find_history_by_song,
     get_history_by_id,
+    get_user_quality,
+    set_user_quality,
 )
 
 # 日志配置
@@ -68,6 +73,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 可选：使用 uvloop 加速事件循环（需在创建 Pyrogram 客户端之前安装）
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # Pyrogram 客户端（用于大文件上传）
 pyrogram_client = None
 PYROGRAM_ENABLED = False
@@ -92,8 +104,14 @@ if TELEGRAM_API_ID and TELEGRAM_API_HASH:
     except Exception as e:
         logger.warning(f"Pyrogram 初始化失败: {e}，将使用标准 Bot API（50MB 限制）")
 
-# 用户设置缓存
-user_quality: dict[int, str] = {}
+# 防止并发启动 Pyrogram 会话
+_pyrogram_lock = asyncio.Lock()
+
+# 下载进度消息的最小更新间隔（秒）
+PROGRESS_UPDATE_INTERVAL = 1.5
+
+# 后台任务（如归档），保留引用避免被回收，关闭时等待完成
+_background_tasks: set[asyncio.Task] = set()
 
 
 # ==================== 工具函数 ====================
@@ -105,59 +123,120 @@ def get_file_extension(quality: str) -> str:
     return ".mp3"
 
 
+def _on_background_task_done(task: asyncio.Task):
+    """后台任务结束回调：释放引用并记录异常"""
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.warning(f"后台任务失败: {task.exception()}")
+
+
+def run_in_background(coro) -> asyncio.Task:
+    """在后台运行协程，不阻塞当前处理流程"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+
+async def get_quality(user_id: int) -> str:
+    """获取用户当前音质，未设置时使用默认音质"""
+    return await get_user_quality(user_id) or DEFAULT_QUALITY
+
+
+def write_temp_file(data: bytes, suffix: str) -> str:
+    """将内容写入临时文件，返回文件路径"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
+        f.write(data)
+        return f.name
+
+
+async def ensure_pyrogram_started():
+    """确保 Pyrogram 会话已连接，整个进程生命周期内复用同一会话"""
+    if pyrogram_client.is_connected:
+        return
+    async with _pyrogram_lock:
+        if not pyrogram_client.is_connected:
+            await pyrogram_client.start()
+            logger.info("Pyrogram 会话已连接")
+
+
 async def upload_large_audio(
     chat_id: int,
-    audio_bytes: bytes,
+    audio_path: str,
     filename: str,
     title: str,
     performer: str,
     caption: str,
     cover_bytes: bytes = b""
 ) -> str:
-    """使用 Pyrogram 上传大文件，返回 file_id"""
+    """使用 Pyrogram 上传大文件（audio_path 为已下载到磁盘的文件），返回 file_id"""
     if not PYROGRAM_ENABLED or not pyrogram_client:
         raise RuntimeError("Pyrogram 未启用")
 
-    # 创建临时文件
-    with tempfile.NamedTemporaryFile(delete=False, suffix=Path(filename).suffix) as audio_file:
-        audio_file.write(audio_bytes)
-        audio_path = audio_file.name
-
-    thumb_path = None
-    if cover_bytes:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as thumb_file:
-            thumb_file.write(cover_bytes)
-            thumb_path = thumb_file.name
+    # 在线程中写临时文件，避免阻塞事件循环
+    thumb_path = await asyncio.to_thread(write_temp_file, cover_bytes, ".jpg") if cover_bytes else None
 
     try:
-        async with pyrogram_client:
-            msg = await pyrogram_client.send_audio(
-                chat_id=chat_id,
-                audio=audio_path,
-                thumb=thumb_path,
-                title=title,
-                performer=performer,
-                caption=caption,
-                file_name=filename
-            )
-            return msg.audio.file_id if msg.audio else ""
+        await ensure_pyrogram_started()
+        msg = await pyrogram_client.send_audio(
+            chat_id=chat_id,
+            audio=audio_path,
+            thumb=thumb_path,
+            title=title,
+            performer=performer,
+            caption=caption,
+            file_name=filename
+        )
+        return msg.audio.file_id if msg.audio else ""
     finally:
-        # 清理临时文件
-        try:
-            os.unlink(audio_path)
-            if thumb_path:
+        # 清理缩略图临时文件（音频文件由调用方负责清理）
+        if thumb_path:
+            try:
                 os.unlink(thumb_path)
-        except Exception:
-            pass
+            except Exception:
+                pass
+
+
+# ==================== 回调数据 ====================
+# 按钮常驻在历史/收藏/下载完成等消息中，callback_data 使用可直接解析的 "action|arg..." 格式，
+# 重启后依然可用；最长的 delfav_list|source|song_id|page 也远小于 Telegram 的 64 字节上限
+
+def cb(action: str, *args) -> str:
+    """构建按钮 callback_data"""
+    return "|".join((action, *map(str, args)))
+
+
+# ==================== 静态菜单 ====================
+# 菜单内容不随请求变化，导入时构建一次并复用（PTB 的 Markup 对象不可变，可安全共享）
+
+QUALITY_OPTIONS = ("128k", "320k", "flac", "flac24bit")
+
+
+def build_quality_markup(current: str) -> InlineKeyboardMarkup:
+    """构建音质选择菜单，当前音质带 ✓ 标记"""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"✓ {q}" if q == current else q, callback_data=cb("quality", q))
+        for q in QUALITY_OPTIONS
+    ]])
+
+
+QUALITY_MARKUPS = {q: build_quality_markup(q) for q in QUALITY_OPTIONS}
+
+TOPLIST_PLATFORM_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(name, callback_data=cb("toplists", source))]
+    for source, name in PLATFORMS.items()
+])
 
 
 # ==================== 鉴权 ====================
 
+# 未配置白名单时对所有用户开放
+PERMISSION_OPEN = not ALLOWED_USER_IDS
+
+
 def is_allowed(user_id: int) -> bool:
     """检查用户是否有权限"""
-    if not ALLOWED_USER_IDS:
-        return True
-    return user_id in ALLOWED_USER_IDS
+    return PERMISSION_OPEN or user_id in ALLOWED_USER_IDS
 
 
 async def check_permission(update: Update) -> bool:
@@ -197,7 +276,7 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_permission(update):
         return
     user_id = update.effective_user.id if update.effective_user else 0
-    current_quality = user_quality.get(user_id, DEFAULT_QUALITY)
+    current_quality = await get_quality(user_id)
     await update.message.reply_text(
         "📖 *帮助文档*\n\n"
         "*基础命令*\n"
@@ -243,7 +322,7 @@ async def cmd_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         source = r.platform
         song_id = r.id
         btn_text = f"{name} - {artist} [{format_platform(source)}]"
-        callback_data = f"dl|{source}|{song_id}"
+        callback_data = cb("dl", source, song_id)
         buttons.append([InlineKeyboardButton(btn_text, callback_data=callback_data)])
 
     await msg.edit_text(
@@ -258,16 +337,11 @@ async def cmd_quality(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user_id = update.effective_user.id
-    current = user_quality.get(user_id, DEFAULT_QUALITY)
-
-    buttons = []
-    for q in ["128k", "320k", "flac", "flac24bit"]:
-        label = f"✓ {q}" if q == current else q
-        buttons.append(InlineKeyboardButton(label, callback_data=f"quality|{q}"))
+    current = await get_quality(user_id)
 
     await update.message.reply_text(
         f"🎧 当前音质: *{current}*\n选择新的音质:",
-        reply_markup=InlineKeyboardMarkup([buttons]),
+        reply_markup=QUALITY_MARKUPS.get(current) or build_quality_markup(current),
         parse_mode=ParseMode.MARKDOWN
     )
 
@@ -308,16 +382,16 @@ async def show_favorites(update: Update, page: int = 0):
         btn_text = f"{item['name'][:15]} - {item['artist'][:10]}"
         # 每行两个按钮：下载和取消收藏
         buttons.append([
-            InlineKeyboardButton(f"📥 {btn_text}", callback_data=f"dl|{source}|{song_id}"),
-            InlineKeyboardButton("💔", callback_data=f"delfav_list|{source}|{song_id}|{page}")
+            InlineKeyboardButton(f"📥 {btn_text}", callback_data=cb("dl", source, song_id)),
+            InlineKeyboardButton("💔", callback_data=cb("delfav_list", source, song_id, page))
         ])
 
     # 分页按钮
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"fav|{page - 1}"))
+        nav_buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=cb("fav", page - 1)))
     if (page + 1) * limit < total:
-        nav_buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"fav|{page + 1}"))
+        nav_buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=cb("fav", page + 1)))
     if nav_buttons:
         buttons.append(nav_buttons)
 
@@ -357,24 +431,28 @@ async def show_history(update: Update, page: int = 0):
             await update.message.reply_text(text)
         return
 
+    # 一次查询整页的收藏状态
+    fav_set = await favorites_lookup((item["source"], item["song_id"]) for item in items)
+
     lines = [f"📜 *下载历史* ({total} 首)\n"]
     buttons = []
     for i, item in enumerate(items, start=offset + 1):
-        lines.append(format_history_item(item, i))
+        is_fav = (item["source"], item["song_id"]) in fav_set
+        lines.append(format_history_item(item, i, is_fav))
         # 如果有 file_id，可以快速重发
         if item.get("file_id"):
-            callback_data = f"resend|{item['id']}"
+            callback_data = cb("resend", item["id"])
         else:
-            callback_data = f"dl|{item['source']}|{item['song_id']}"
+            callback_data = cb("dl", item["source"], item["song_id"])
         btn_text = f"{item['name'][:15]} - {item['artist'][:10]}"
         buttons.append([InlineKeyboardButton(btn_text, callback_data=callback_data)])
 
     # 分页按钮
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"history|{page - 1}"))
+        nav_buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=cb("history", page - 1)))
     if (page + 1) * limit < total:
-        nav_buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"history|{page + 1}"))
+        nav_buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=cb("history", page + 1)))
     if nav_buttons:
         buttons.append(nav_buttons)
 
@@ -393,13 +471,9 @@ async def cmd_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # 显示平台选择
-    buttons = []
-    for source, name in PLATFORMS.items():
-        buttons.append([InlineKeyboardButton(name, callback_data=f"toplists|{source}")])
-
     await update.message.reply_text(
         "📊 选择平台查看排行榜:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=TOPLIST_PLATFORM_MARKUP
     )
 
 
@@ -419,84 +493,61 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not data:
         return
 
-    parts = data.split("|")
-    action = parts[0]
+    action, _, args = data.partition("|")
+    handler = CALLBACK_HANDLERS.get(action)
+    if handler is None:
+        return
 
     try:
-        if action == "dl":
-            if len(parts) >= 3:
-                await handle_download(update, context, parts[1], parts[2])
-        elif action == "quality":
-            if len(parts) >= 2:
-                await handle_quality_change(update, context, parts[1])
-        elif action == "fav":
-            if len(parts) >= 2:
-                await show_favorites(update, int(parts[1]))
-        elif action == "history":
-            if len(parts) >= 2:
-                await show_history(update, int(parts[1]))
-        elif action == "addfav":
-            if len(parts) >= 3:
-                await handle_add_favorite(update, context, parts[1], parts[2])
-        elif action == "delfav":
-            if len(parts) >= 3:
-                await handle_del_favorite(update, context, parts[1], parts[2])
-        elif action == "delfav_list":
-            # 从收藏列表删除，删除后刷新列表
-            if len(parts) >= 4:
-                await handle_del_favorite_from_list(update, context, parts[1], parts[2], int(parts[3]))
-        elif action == "toplists":
-            if len(parts) >= 2:
-                await handle_toplists(update, context, parts[1])
-        elif action == "toplist":
-            if len(parts) >= 3:
-                await handle_toplist_songs(update, context, parts[1], parts[2])
-        elif action == "resend":
-            if len(parts) >= 2:
-                await handle_resend(update, context, int(parts[1]))
-        elif action == "back_toplists":
-            await handle_back_toplists(update, context)
+        await handler(update, context, args)
     except (IndexError, ValueError) as e:
         logger.warning(f"回调数据解析失败: {data}, 错误: {e}")
         await query.edit_message_text("❌ 操作无效，请重试")
 
 
+async def send_from_history(query, context: ContextTypes.DEFAULT_TYPE, history: dict) -> bool:
+    """复用历史记录中的 file_id 发送歌曲，成功返回 True"""
+    await query.edit_message_text("📤 发送中 (从缓存)...")
+    try:
+        sent_msg = await context.bot.send_audio(
+            chat_id=query.message.chat_id,
+            # 以 file_id 发送时沿用服务端已有的缩略图，无需重新获取封面
+            audio=history["file_id"],
+            caption=format_song_caption(
+                history["name"],
+                history["artist"],
+                history.get("album", ""),
+                history.get("quality", ""),
+                source=history["source"]
+            )
+        )
+        run_in_background(archive_to_channel(context, sent_msg, history["source"]))
+        await query.delete_message()
+        return True
+    except Exception as e:
+        logger.warning(f"file_id 复用失败: {e}")
+        return False
+
+
 async def handle_download(update: Update, context: ContextTypes.DEFAULT_TYPE, source: str, song_id: str):
     """处理下载"""
     query = update.callback_query
     user_id = query.from_user.id
-    quality = user_quality.get(user_id, DEFAULT_QUALITY)
+    quality = await get_quality(user_id)
 
     await query.edit_message_text("⏳ 正在解析歌曲...")
 
     # 检查历史记录是否有 file_id 可复用
     history = await find_history_by_song(source, song_id)
     if history and history.get("file_id"):
-        await query.edit_message_text("📤 发送中 (从缓存)...")
-        try:
-            # 获取封面用于缩略图（需要先解析获取封面 URL）
-            parse_result = await client.parse_songs(source, song_id, quality)
-            cover_bytes = b""
-            if parse_result and parse_result[0].cover:
-                cover_bytes = await client.download_bytes(parse_result[0].cover)
-            sent_msg = await context.bot.send_audio(
-                chat_id=query.message.chat_id,
-                audio=history["file_id"],
-                thumbnail=io.BytesIO(cover_bytes) if cover_bytes else None,
-                caption=format_song_caption(
-                    history["name"],
-                    history["artist"],
-                    history.get("album", ""),
-                    history.get("quality", ""),
-                    source=source
-                )
-            )
-            await archive_to_channel(context, sent_msg, source)
-            await query.delete_message()
+        if await send_from_history(query, context, history):
             return
-        except Exception as e:
-            logger.warning(f"file_id 复用失败: {e}")
 
+    await download_and_send(query, context, source, song_id, quality)
+
+
+async def download_and_send(query, context: ContextTypes.DEFAULT_TYPE, source: str, song_id: str, quality: str):
+    """解析、下载并发送歌曲"""
     # 使用 V3 API 解析歌曲
     parse_results = await client.parse_songs(source, song_id, quality)
     if not parse_results or not parse_results[0].success:
@@ -516,114 +567,128 @@ async def handle_download(update: Update, context: ContextTypes.DEFAULT_TYPE, so
         return
 
     # 下载音频内容（带进度显示）
-    last_progress_update = [0]  # 用列表以便在闭包中修改
+    last_update_ts = 0.0
+    last_percent = -1
+    progress_task: Optional[asyncio.Task] = None
+
+    async def edit_progress(text: str):
+        try:
+            await query.edit_message_text(text)
+        except Exception:
+            pass  # 忽略编辑失败（如消息内容相同）
 
     async def progress_callback(downloaded: int, total: int):
-        """下载进度回调"""
+        """下载进度回调：按时间节流，并在后台编辑消息，不阻塞下载"""
+        nonlocal last_update_ts, last_percent, progress_task
         percent = int(downloaded * 100 / total)
-        # 每10%更新一次，避免频繁编辑消息
-        if percent >= last_progress_update[0] + 10:
-            last_progress_update[0] = percent
-            progress_bar = "▓" * (percent // 10) + "░" * (10 - percent // 10)
-            try:
-                await query.edit_message_text(
-                    f"⏳ 下载中: {result.name}\n"
-                    f"{progress_bar} {percent}%\n"
-                    f"📦 {format_file_size(downloaded)} / {format_file_size(total)}"
-                )
-            except Exception:
-                pass  # 忽略编辑失败（如消息内容相同）
-
-    await query.edit_message_text(f"⏳ 开始下载: {result.name}...")
-    audio_bytes = await client.download_audio(result.url, progress_callback)
-    if not audio_bytes:
-        await query.edit_message_text("❌ 下载音频失败")
-        return
-
-    # 获取封面
-    cover_bytes = await client.download_bytes(result.cover) if result.cover else b""
-
-    await query.edit_message_text("📤 发送中...")
-
-    # 构建换源提示
-    source_switched = ""
-    if result.was_downgraded:
-        source_switched = f"🔄 音质已从 {quality} 降级到 {result.actual_quality}"
-
-    # 发送音频
-    caption = format_song_caption(
-        result.name,
-        result.artist,
-        result.album,
-        result.actual_quality,
-        len(audio_bytes),
-        source,
-        source_switched
-    )
+        now = time.monotonic()
+        if percent == last_percent or now - last_update_ts < PROGRESS_UPDATE_INTERVAL:
+            return
+        if progress_task and not progress_task.done():
+            return  # 上一次编辑仍在进行
+        last_update_ts = now
+        last_percent = percent
+        progress_bar = "▓" * (percent // 10) + "░" * (10 - percent // 10)
+        progress_task = asyncio.create_task(edit_progress(
+            f"⏳ 下载中: {result.name}\n"
+            f"{progress_bar} {percent}%\n"
+            f"📦 {format_file_size(downloaded)} / {format_file_size(total)}"
+        ))
 
     # 根据实际音质确定文件扩展名
     ext = get_file_extension(result.actual_quality)
     filename = f"{result.name} - {result.artist}{ext}"
 
-    file_id = ""
+    # 流式下载到临时文件，避免整个音频驻留内存
+    audio_file = tempfile.NamedTemporaryFile(suffix=ext, delete=False)
     try:
-        # 根据文件大小选择上传方式
-        if len(audio_bytes) > MAX_FILE_SIZE and PYROGRAM_ENABLED:
-            # 大文件使用 Pyrogram 上传
-            await query.edit_message_text(f"📤 上传大文件中 ({format_file_size(len(audio_bytes))})...")
-            file_id = await upload_large_audio(
-                chat_id=query.message.chat_id,
-                audio_bytes=audio_bytes,
-                filename=filename,
-                title=result.name,
-                performer=result.artist,
-                caption=caption,
-                cover_bytes=cover_bytes
-            )
-            sent_msg = None  # Pyrogram 发送的消息，归档需要单独处理
-        else:
-            # 普通文件使用 python-telegram-bot
-            sent_msg = await context.bot.send_audio(
-                chat_id=query.message.chat_id,
-                audio=io.BytesIO(audio_bytes),
-                thumbnail=io.BytesIO(cover_bytes) if cover_bytes else None,
-                title=result.name,
-                performer=result.artist,
-                caption=caption,
-                filename=filename
-            )
-            file_id = sent_msg.audio.file_id if sent_msg and sent_msg.audio else ""
-    except Exception as e:
-        logger.error(f"发送音频失败: {e}")
-        await query.edit_message_text(f"❌ 发送失败: {e}")
-        return
+        await query.edit_message_text(f"⏳ 开始下载: {result.name}...")
+        audio_size = await client.download_audio(result.url, audio_file, progress_callback)
+        # 等待最后一次进度编辑完成，避免其覆盖后续状态消息
+        if progress_task:
+            await progress_task
+        if not audio_size:
+            await query.edit_message_text("❌ 下载音频失败")
+            return
+
+        # 获取封面
+        cover_bytes = await client.download_bytes(result.cover) if result.cover else b""
+
+        await query.edit_message_text("📤 发送中...")
+
+        # 构建换源提示
+        source_switched = ""
+        if result.was_downgraded:
+            source_switched = f"🔄 音质已从 {quality} 降级到 {result.actual_quality}"
+
+        # 发送音频
+        caption = format_song_caption(
+            result.name,
+            result.artist,
+            result.album,
+            result.actual_quality,
+            audio_size,
+            source,
+            source_switched
+        )
+
+        file_id = ""
+        try:
+            # 根据文件大小选择上传方式
+            if audio_size > MAX_FILE_SIZE and PYROGRAM_ENABLED:
+                # 大文件使用 Pyrogram 上传
+                await query.edit_message_text(f"📤 上传大文件中 ({format_file_size(audio_size)})...")
+                file_id = await upload_large_audio(
+                    chat_id=query.message.chat_id,
+                    audio_path=audio_file.name,
+                    filename=filename,
+                    title=result.name,
+                    performer=result.artist,
+                    caption=caption,
+                    cover_bytes=cover_bytes
+                )
+                sent_msg = None  # Pyrogram 发送的消息，归档需要单独处理
+            else:
+                # 普通文件使用 python-telegram-bot
+                audio_file.seek(0)
+                sent_msg = await context.bot.send_audio(
+                    chat_id=query.message.chat_id,
+                    audio=audio_file,
+                    thumbnail=cover_bytes or None,
+                    title=result.name,
+                    performer=result.artist,
+                    caption=caption,
+                    filename=filename
+                )
+                file_id = sent_msg.audio.file_id if sent_msg and sent_msg.audio else ""
+        except Exception as e:
+            logger.error(f"发送音频失败: {e}")
+            await query.edit_message_text(f"❌ 发送失败: {e}")
+            return
+    finally:
+        # 清理临时文件
+        audio_file.close()
+        try:
+            os.unlink(audio_file.name)
+        except Exception:
+            pass
 
     # 保存历史记录
     await add_history(source, song_id, result.name, result.artist, result.album, result.actual_quality, file_id)
 
-    # 归档到频道
+    # 归档到频道（后台执行，不阻塞用户侧的完成提示）
     if sent_msg:
-        await archive_to_channel(context, sent_msg, source)
-    elif file_id and ARCHIVE_CHANNEL_ID:
+        run_in_background(archive_to_channel(context, sent_msg, source))
+    elif file_id:
         # Pyrogram 上传后需要单独归档
-        try:
-            archive_hashtags = make_hashtags(result.name, result.artist, result.album, source)
-            archive_caption = caption + "\n\n" + archive_hashtags if archive_hashtags else caption
-            await context.bot.send_audio(
-                chat_id=ARCHIVE_CHANNEL_ID,
-                audio=file_id,
-                caption=archive_caption
-            )
-            logger.info(f"归档成功: {result.name}")
-        except Exception as e:
-            logger.warning(f"归档失败: {e}")
+        run_in_background(archive_file_id(context, file_id, caption, result, source))
 
     # 更新消息，显示收藏按钮
     is_fav = await is_favorite(source, song_id)
     if is_fav:
-        fav_btn = InlineKeyboardButton("💔 取消收藏", callback_data=f"delfav|{source}|{song_id}")
+        fav_btn = InlineKeyboardButton("💔 取消收藏", callback_data=cb("delfav", source, song_id))
     else:
-        fav_btn = InlineKeyboardButton("❤️ 收藏", callback_data=f"addfav|{source}|{song_id}")
+        fav_btn = InlineKeyboardButton("❤️ 收藏", callback_data=cb("addfav", source, song_id))
 
     await query.edit_message_text(
         f"✅ 下载完成: {result.name} - {result.artist}\n📊 音质: {result.actual_quality}",
@@ -640,7 +705,7 @@ async def handle_quality_change(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text("❌ 无效的音质选项")
         return
 
-    user_quality[user_id] = quality
+    await set_user_quality(user_id, quality)
     await query.edit_message_text(f"✅ 音质已切换为: *{quality}*", parse_mode=ParseMode.MARKDOWN)
 
 
@@ -655,7 +720,7 @@ async def handle_add_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.edit_message_text(
             f"❤️ 已收藏: {result.name} - {result.artist}",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("💔 取消收藏", callback_data=f"delfav|{source}|{song_id}")
+                InlineKeyboardButton("💔 取消收藏", callback_data=cb("delfav", source, song_id))
             ]])
         )
     else:
@@ -669,7 +734,7 @@ async def handle_del_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.edit_message_text(
         "💔 已取消收藏",
         reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton("❤️ 重新收藏", callback_data=f"addfav|{source}|{song_id}")
+            InlineKeyboardButton("❤️ 重新收藏", callback_data=cb("addfav", source, song_id))
         ]])
     )
 
@@ -695,10 +760,10 @@ async def handle_toplists(update: Update, context: ContextTypes.DEFAULT_TYPE, so
     for item in toplists[:15]:
         list_id = item.id
         name = item.name[:25]
-        buttons.append([InlineKeyboardButton(name, callback_data=f"toplist|{source}|{list_id}")])
+        buttons.append([InlineKeyboardButton(name, callback_data=cb("toplist", source, list_id))])
 
     # 返回按钮
-    buttons.append([InlineKeyboardButton("🔙 返回", callback_data="back_toplists")])
+    buttons.append([InlineKeyboardButton("🔙 返回", callback_data=cb("back_toplists"))])
 
     await query.edit_message_text(
         f"📊 *{format_platform(source)} 排行榜*",
@@ -725,10 +790,10 @@ async def handle_toplist_songs(update: Update, context: ContextTypes.DEFAULT_TYP
         name = song.name[:20]
         artist = song.artist[:10] if song.artist else ""
         btn_text = f"{name} - {artist}" if artist else name
-        buttons.append([InlineKeyboardButton(btn_text, callback_data=f"dl|{source}|{song_id}")])
+        buttons.append([InlineKeyboardButton(btn_text, callback_data=cb("dl", source, song_id))])
 
     # 返回按钮
-    buttons.append([InlineKeyboardButton("🔙 返回", callback_data=f"toplists|{source}")])
+    buttons.append([InlineKeyboardButton("🔙 返回", callback_data=cb("toplists", source))])
 
     await query.edit_message_text(
         "📊 选择要下载的歌曲:",
@@ -739,13 +804,9 @@ async def handle_toplist_songs(update: Update, context: ContextTypes.DEFAULT_TYP
 async def handle_back_toplists(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """返回排行榜平台选择"""
     query = update.callback_query
-    buttons = []
-    for source, name in PLATFORMS.items():
-        buttons.append([InlineKeyboardButton(name, callback_data=f"toplists|{source}")])
-
     await query.edit_message_text(
         "📊 选择平台查看排行榜:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=TOPLIST_PLATFORM_MARKUP
     )
 
 
@@ -765,32 +826,27 @@ async def handle_resend(update: Update, context: ContextTypes.DEFAULT_TYPE, hist
         await handle_download(update, context, history["source"], history["song_id"])
         return
 
-    await query.edit_message_text("📤 发送中 (从缓存)...")
+    if not await send_from_history(query, context, history):
+        # 复用失败，回退到重新下载
+        await handle_download(update, context, history["source"], history["song_id"])
+
+
+async def archive_file_id(context: ContextTypes.DEFAULT_TYPE, file_id: str, caption: str, result, source: str):
+    """按 file_id 归档到私人频道（用于 Pyrogram 上传的大文件）"""
+    if not ARCHIVE_CHANNEL_ID:
+        return
 
     try:
-        # 获取封面用于缩略图
-        cover_bytes = b""
-        parse_results = await client.parse_songs(history["source"], history["song_id"], "320k")
-        if parse_results and parse_results[0].cover:
-            cover_bytes = await client.download_bytes(parse_results[0].cover)
-        sent_msg = await context.bot.send_audio(
-            chat_id=query.message.chat_id,
+        archive_hashtags = make_hashtags(result.name, result.artist, result.album, source)
+        archive_caption = caption + "\n\n" + archive_hashtags if archive_hashtags else caption
+        await context.bot.send_audio(
+            chat_id=ARCHIVE_CHANNEL_ID,
             audio=file_id,
-            thumbnail=io.BytesIO(cover_bytes) if cover_bytes else None,
-            caption=format_song_caption(
-                history["name"],
-                history["artist"],
-                history.get("album", ""),
-                history.get("quality", ""),
-                source=history["source"]
-            )
+            caption=archive_caption
         )
-        await archive_to_channel(context, sent_msg, history["source"])
-        await query.delete_message()
+        logger.info(f"归档成功: {result.name}")
     except Exception as e:
-        logger.warning(f"重发失败: {e}")
-        # 回退到重新下载
-        await handle_download(update, context, history["source"], history["song_id"])
+        logger.warning(f"归档失败: {e}")
 
 
 async def archive_to_channel(context: ContextTypes.DEFAULT_TYPE, sent_msg, source: str):
@@ -827,6 +883,74 @@ async def archive_to_channel(context: ContextTypes.DEFAULT_TYPE, sent_msg, sourc
         logger.error(f"归档失败: {e}")
 
 
+# ==================== 回调分发表 ====================
+# 各处理函数接收 cb() 拼接的参数串 "arg1|arg2..." 并自行解析
+
+async def _cb_download(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    source, song_id = args.split("|", 1)
+    await handle_download(update, context, source, song_id)
+
+
+async def _cb_quality(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    await handle_quality_change(update, context, args)
+
+
+async def _cb_favorites(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    await show_favorites(update, int(args))
+
+
+async def _cb_history(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    await show_history(update, int(args))
+
+
+async def _cb_add_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    source, song_id = args.split("|", 1)
+    await handle_add_favorite(update, context, source, song_id)
+
+
+async def _cb_del_favorite(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    source, song_id = args.split("|", 1)
+    await handle_del_favorite(update, context, source, song_id)
+
+
+async def _cb_del_favorite_from_list(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    # 从收藏列表删除，删除后刷新列表
+    source, song_id, page = args.split("|", 2)
+    await handle_del_favorite_from_list(update, context, source, song_id, int(page))
+
+
+async def _cb_toplists(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    await handle_toplists(update, context, args)
+
+
+async def _cb_toplist(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    source, list_id = args.split("|", 1)
+    await handle_toplist_songs(update, context, source, list_id)
+
+
+async def _cb_resend(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    await handle_resend(update, context, int(args))
+
+
+async def _cb_back_toplists(update: Update, context: ContextTypes.DEFAULT_TYPE, args: str):
+    await handle_back_toplists(update, context)
+
+
+CALLBACK_HANDLERS = {
+    "dl": _cb_download,
+    "quality": _cb_quality,
+    "fav": _cb_favorites,
+    "history": _cb_history,
+    "addfav": _cb_add_favorite,
+    "delfav": _cb_del_favorite,
+    "delfav_list": _cb_del_favorite_from_list,
+    "toplists": _cb_toplists,
+    "toplist": _cb_toplist,
+    "resend": _cb_resend,
+    "back_toplists": _cb_back_toplists,
+}
+
+
 # ==================== Inline 模式 ====================
 
 async def inline_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -916,9 +1040,34 @@ async def post_init(application: Application):
         ("help", "获取帮助"),
     ])
 
+    # 预先建立 Pyrogram 会话，避免首次上传时握手
+    if PYROGRAM_ENABLED:
+        try:
+            await ensure_pyrogram_started()
+        except Exception as e:
+            logger.warning(f"Pyrogram 会话启动失败: {e}，将在上传时重试")
+
     logger.info("TuneBot 启动完成")
 
 
+async def post_stop(application: Application):
+    """应用停止后、关闭 Bot 连接前，等待尚未完成的后台任务（如归档）"""
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+
+async def post_shutdown(application: Application):
+    """应用关闭时释放资源"""
+    if pyrogram_client and pyrogram_client.is_connected:
+        try:
+            await pyrogram_client.stop()
+        except Exception as e:
+            logger.warning(f"Pyrogram 会话关闭失败: {e}")
+
+    await client.close()
+    await close_db()
+
+
 def main():
     """主函数"""
     if not BOT_TOKEN:
@@ -926,7 +1075,14 @@ def main():
         return
 
     # 创建应用
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # 注册处理器
     app.add_handler(CommandHandler("start", cmd_start))
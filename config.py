@@ -1,6 +1,7 @@
 """TuneBot 配置模块"""
 import os
 from pathlib import Path
+from types import MappingProxyType
 
 # 项目根目录
 BASE_DIR = Path(__file__).parent
@@ -21,15 +22,22 @@ if _archive_id.strip():
     except ValueError:
         pass
 
+
+def _parse_ids(value: str):
+    """解析逗号分隔的用户 ID，忽略空项"""
+    for token in value.split(","):
+        token = token.strip()
+        if token:
+            yield int(token)
+
+
 # 允许使用的用户 ID (自用)
 _allowed_ids = os.getenv("ALLOWED_USER_IDS", "")
-ALLOWED_USER_IDS: set[int] = set()
-if _allowed_ids.strip():
-    ALLOWED_USER_IDS = set(int(uid.strip()) for uid in _allowed_ids.split(",") if uid.strip())
+ALLOWED_USER_IDS: frozenset[int] = frozenset(_parse_ids(_allowed_ids))
 
 # 默认音质
 DEFAULT_QUALITY = os.getenv("DEFAULT_QUALITY", "320k")
-VALID_QUALITIES = {"128k", "320k", "flac", "flac24bit"}
+VALID_QUALITIES = frozenset({"128k", "320k", "flac", "flac24bit"})
 
 # TuneHub API V3
 API_BASE_URL = os.getenv("API_BASE_URL", "https://tunehub.sayqz.com/api")
@@ -42,8 +50,8 @@ DB_PATH = BASE_DIR / "data" / "tunebot.db"
 MAX_FILE_SIZE = 50 * 1024 * 1024
 
 # 平台代码
-PLATFORMS = {
+PLATFORMS = MappingProxyType({
     "netease": "网易云",
     "kuwo": "酷我",
     "qq": "QQ音乐",
-}
+})
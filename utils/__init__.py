@@ -18,11 +18,14 @@ from utils.formatters import (
     make_hashtag,
     make_hashtags,
 )
+from utils.cache import TTLCache
 from utils.db import (
     init_db,
+    close_db,
     add_favorite,
     remove_favorite,
     is_favorite,
+    favorites_lookup,
     get_favorites,
     get_favorites_count,
     add_history,
@@ -30,6 +33,8 @@ from utils.db import (
     get_history_count,
     find_history_by_song,
     get_history_by_id,
+    get_user_quality,
+    set_user_quality,
 )
 
 __all__ = [
@@ -39,6 +44,8 @@ __all__ = [
     "SearchResult",
     "ParseResult",
     "ToplistItem",
+    # 缓存
+    "TTLCache",
     # 格式化
     "format_file_size",
     "format_platform",
@@ -52,9 +59,11 @@ __all__ = [
     "make_hashtags",
     # 数据库
     "init_db",
+    "close_db",
     "add_favorite",
     "remove_favorite",
     "is_favorite",
+    "favorites_lookup",
     "get_favorites",
     "get_favorites_count",
     "add_history",
@@ -62,4 +71,6 @@ __all__ = [
     "get_history_count",
     "find_history_by_song",
     "get_history_by_id",
+    "get_user_quality",
+    "set_user_quality",
 ]
@@ -1,18 +1,67 @@
 """TuneBot API 客户端 - TuneHub V3 API 封装"""
+import ast
 import asyncio
 import aiohttp
 import logging
+import random
 import execjs
+import hashlib
+import operator
+import orjson
 import re
-from typing import Optional
+import yarl
+from types import CodeType
+from typing import BinaryIO, Optional
 from dataclasses import dataclass
 
 from config import API_BASE_URL, API_KEY, MAX_FILE_SIZE, PLATFORMS
+from utils.cache import TTLCache
+from utils.db import get_cached_method, set_cached_method
 
 logger = logging.getLogger(__name__)
 
+# JSON 编解码统一使用 orjson
+_loads = orjson.loads
+_dumps = orjson.dumps
 
-@dataclass
+# 封面、文件大小等 CDN 小请求的超时
+CDN_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+# 下载进度回调的最小间隔（字节），避免每个网络分片都触发回调
+PROGRESS_CALLBACK_BYTES = 256 * 1024
+
+# 音频下载请求头模板，使用时复制
+DOWNLOAD_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+
+# 需要防盗链 Referer 的音频域名：域名后缀 -> Referer
+_REFERERS = {
+    "kuwo.cn": "https://www.kuwo.cn/",
+    "kugou.com": "https://www.kugou.com/",
+}
+
+# 下载重试的退避参数（秒）
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 60.0
+
+# 下载时可以重试的 4xx 状态码（其余 4xx 直接失败）
+RETRYABLE_CLIENT_STATUSES = frozenset({408, 429})
+
+# transform 函数预处理结果的缓存上限（平台 × 功能数量很少）
+TRANSFORM_CACHE_SIZE = 64
+
+# 方法配置在数据库中的缓存时间（秒），重启后无需重新获取
+METHOD_CACHE_TTL = 24 * 3600
+
+# 同时进行的平台搜索请求上限，平台增多时避免瞬间占满连接池
+SEARCH_CONCURRENCY = 8
+
+# 聚合搜索中单个平台的最长等待时间（秒）
+SEARCH_TIMEOUT = 5.0
+
+
+@dataclass(slots=True, frozen=True)
 class SearchResult:
     """搜索结果"""
     id: str
@@ -22,7 +71,7 @@ class SearchResult:
     platform: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class ParseResult:
     """解析结果"""
     success: bool
@@ -41,7 +90,7 @@ class ParseResult:
     expire: int = 1800
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ToplistItem:
     """排行榜项"""
     id: str
@@ -50,44 +99,145 @@ class ToplistItem:
     update_frequency: str = ""
 
 
+# 模板表达式允许的语法节点：变量、常量、||、&& 与四则运算
+_SAFE_EXPR_NODES = (
+    ast.Expression, ast.BinOp, ast.BoolOp, ast.UnaryOp, ast.Name, ast.Load, ast.Constant,
+    ast.Or, ast.And, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.USub, ast.UAdd,
+)
+_JS_BOOL_OPS = re.compile(r'\|\||&&')
+
+# 模板中的 {{expr}} 表达式
+_TEMPLATE_EXPR = re.compile(r'\{\{([^}]+)\}\}')
+# JavaScript 变量名中不允许的字符
+_UNSAFE_JS_IDENT = re.compile(r'[^a-zA-Z_$]')
+
+
+_ARITH_OPS = {"Sub": operator.sub, "Mult": operator.mul, "Div": operator.truediv}
+
+
+def _arith(op: str, left, right):
+    """数值运算：字符串操作数在 JS 中会先转为数字，Python 语义不同，抛错交给 JS 引擎"""
+    if isinstance(left, str) or isinstance(right, str):
+        raise TypeError("string operand")
+    return _ARITH_OPS[op](left, right)
+
+
+class _CheckedArith(ast.NodeTransformer):
+    """将 -、*、/ 改写为 _arith 调用（+ 的 str + str 与 JS 一致，其余混合类型 Python 会直接报错）"""
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Add):
+            return node
+        call = ast.Call(
+            func=ast.Name(id="__arith", ctx=ast.Load()),
+            args=[ast.Constant(type(node.op).__name__), node.left, node.right],
+            keywords=[],
+        )
+        return ast.copy_location(call, node)
+
+
+def _compile_expr(expr: str) -> Optional[CodeType]:
+    """将简单的 JS 模板表达式编译为 Python 代码对象，不支持的表达式返回 None"""
+    py_expr = _JS_BOOL_OPS.sub(lambda m: " or " if m.group(0) == "||" else " and ", expr)
+    try:
+        tree = ast.parse(py_expr, mode="eval")
+    except SyntaxError:
+        return None
+    if not all(isinstance(node, _SAFE_EXPR_NODES) for node in ast.walk(tree)):
+        return None
+    tree = ast.fix_missing_locations(_CheckedArith().visit(tree))
+    return compile(tree, "<template>", "eval")
+
+
+def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """计算第 attempt 次失败后的等待时间：带抖动的指数退避，并遵循 Retry-After"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (attempt - 1))) * (0.5 + random.random())
+    if retry_after:
+        try:
+            delay = max(delay, min(RETRY_MAX_DELAY, float(retry_after)))
+        except ValueError:
+            pass
+    return delay
+
+
 class TuneHubClient:
     """TuneHub V3 API 客户端"""
 
     def __init__(self, base_url: str = API_BASE_URL, api_key: str = API_KEY):
         self.base_url = base_url.rstrip("/")
         self.api_key = api_key
+        # 请求头（包含认证）在客户端生命周期内不变，只构建一次
+        self._headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            self._headers["X-API-Key"] = self.api_key
+        # 预先解析固定的接口地址，避免每次请求重新拼接和解析
+        self._parse_url = yarl.URL(f"{self.base_url}/v1/parse")
         self._session: Optional[aiohttp.ClientSession] = None
+        # 访问音频/封面 CDN 的专用 Session，复用到 CDN 的长连接
+        self._download_session: Optional[aiohttp.ClientSession] = None
+        # 模板表达式编译缓存：表达式 -> 代码对象（None 表示需交给 JS 引擎计算）
+        self._expr_cache: dict[str, Optional[CodeType]] = {}
+        # transform 预处理缓存：源码哈希 -> 函数体（None 表示不可执行）
+        self._transform_cache: dict[str, Optional[str]] = {}
+        # 平台搜索并发限制
+        self._search_sem = asyncio.Semaphore(SEARCH_CONCURRENCY)
         # 缓存方法配置
         self._method_cache: dict[str, dict] = {}
+        # 解析结果缓存：(platform, song_ids, quality) -> list[ParseResult]
+        self._parse_cache = TTLCache(maxsize=512, ttl=600)
+        # 封面缓存：url -> bytes
+        self._cover_cache = TTLCache(maxsize=64, ttl=600)
+        # 聚合搜索缓存：规范化关键词 -> list[SearchResult]
+        self._search_cache = TTLCache(maxsize=1024, ttl=60)
+        # 排行榜缓存：platform -> list[ToplistItem]，(platform, list_id) -> list[SearchResult]
+        self._toplist_cache = TTLCache(maxsize=256, ttl=600)
 
     async def _get_session(self) -> aiohttp.ClientSession:
         """获取或创建 aiohttp Session"""
         if self._session is None or self._session.closed:
             timeout = aiohttp.ClientTimeout(total=60)
-            self._session = aiohttp.ClientSession(timeout=timeout)
+            # 限制并发连接数，保持长连接并缓存 DNS 解析结果
+            connector = aiohttp.TCPConnector(
+                limit=200,
+                limit_per_host=16,
+                use_dns_cache=True,
+                ttl_dns_cache=600,
+                keepalive_timeout=75,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(timeout=timeout, connector=connector)
         return self._session
 
+    async def _get_download_session(self) -> aiohttp.ClientSession:
+        """获取或创建访问音频/封面 CDN 的专用 Session（超时由每次请求单独指定）"""
+        if self._download_session is None or self._download_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=32,
+                limit_per_host=8,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            )
+            self._download_session = aiohttp.ClientSession(connector=connector)
+        return self._download_session
+
     async def close(self):
         """关闭 Session"""
         if self._session and not self._session.closed:
             await self._session.close()
             self._session = None
+        if self._download_session and not self._download_session.closed:
+            await self._download_session.close()
+            self._download_session = None
 
-    def _get_headers(self) -> dict:
-        """获取请求头（包含认证）"""
-        headers = {"Content-Type": "application/json"}
-        if self.api_key:
-            headers["X-API-Key"] = self.api_key
-        return headers
-
-    async def _request(self, method: str, url: str, **kwargs) -> dict:
+    async def _request(self, method: str, url: "str | yarl.URL", **kwargs) -> dict:
         """发送请求"""
         session = await self._get_session()
-        logger.debug(f"API 请求: {method} {url}")
-        resp = await session.request(method, url, **kwargs)
-        logger.debug(f"API 响应: status={resp.status}")
-        data = await resp.json()
-        return data
+        logger.debug("API 请求: %s %s", method, url)
+        async with session.request(method, url, **kwargs) as resp:
+            logger.debug("API 响应: status=%s", resp.status)
+            # TuneHub 接口固定返回 UTF-8 JSON，直接解析原始字节
+            return _loads(await resp.read())
 
     # ==================== 解析接口（消耗积分）===================
 
@@ -107,19 +257,25 @@ class TuneHubClient:
         Returns:
             ParseResult 列表
         """
+        cache_key = (platform, song_ids, quality)
+        cached = self._parse_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("解析缓存命中: %s", cache_key)
+            return cached
+
         try:
-            url = f"{self.base_url}/v1/parse"
+            url = self._parse_url
             payload = {
                 "platform": platform,
                 "ids": song_ids,
                 "quality": quality
             }
 
-            data = await self._request("POST", url, json=payload, headers=self._get_headers())
+            data = await self._request("POST", url, data=_dumps(payload), headers=self._headers)
 
             if data.get("code") != 0:
                 msg = data.get("message", "未知错误")
-                logger.warning(f"解析请求失败: {msg}")
+                logger.warning("解析请求失败: %s", msg)
                 return []
 
             results = []
@@ -147,16 +303,22 @@ class TuneHubClient:
                         song_id=item.get("id", ""),
                         error=item.get("error", "解析失败")
                     ))
+
+            # 仅缓存全部成功的结果，且不超过音频链接的有效期
+            if results and all(r.success for r in results):
+                ttl = min(self._parse_cache.ttl, min(r.expire for r in results) - 60)
+                if ttl > 0:
+                    self._parse_cache.set(cache_key, results, ttl)
             return results
 
         except aiohttp.ClientError as e:
-            logger.warning(f"网络请求错误: {e}")
+            logger.warning("网络请求错误: %s", e)
             return []
         except (KeyError, TypeError, ValueError) as e:
-            logger.warning(f"数据解析错误: {e}")
+            logger.warning("数据解析错误: %s", e)
             return []
         except Exception as e:
-            logger.warning(f"解析失败: {e}", exc_info=True)
+            logger.warning("解析失败: %s", e, exc_info=True)
             return []
 
     # ==================== 方法下发模式（不消耗积分）===================
@@ -167,22 +329,59 @@ class TuneHubClient:
         if cache_key in self._method_cache:
             return self._method_cache[cache_key]
 
+        # 内存未命中时查询数据库缓存
+        try:
+            cached = await get_cached_method(cache_key)
+            if cached is not None:
+                config = _loads(cached)
+                self._method_cache[cache_key] = config
+                return config
+        except Exception as e:
+            logger.warning("读取方法配置缓存失败: %s", e)
+
         try:
             url = f"{self.base_url}/v1/methods/{platform}/{function}"
-            logger.debug(f"获取方法配置: {url}")
-            data = await self._request("GET", url, headers=self._get_headers())
+            logger.debug("获取方法配置: %s", url)
+            data = await self._request("GET", url, headers=self._headers)
 
             if data.get("code") == 0:
                 config = data.get("data")
                 self._method_cache[cache_key] = config
+                if config:
+                    try:
+                        await set_cached_method(cache_key, _dumps(config), METHOD_CACHE_TTL)
+                    except Exception as e:
+                        logger.warning("写入方法配置缓存失败: %s", e)
                 return config
-            logger.warning(f"获取方法配置失败: code={data.get('code')}, message={data.get('message')}")
+            logger.warning("获取方法配置失败: code=%s, message=%s", data.get("code"), data.get("message"))
             return None
 
         except Exception as e:
-            logger.warning(f"获取方法配置失败: {e}")
+            logger.warning("获取方法配置失败: %s", e)
             return None
 
+    def _eval_expr(self, expr: str, variables: dict) -> Optional[str]:
+        """用 Python 计算简单的模板表达式，无法处理时返回 None"""
+        if expr not in self._expr_cache:
+            self._expr_cache[expr] = _compile_expr(expr)
+        code = self._expr_cache[expr]
+        if code is None:
+            return None
+
+        try:
+            value = eval(code, {"__builtins__": {}, "__arith": _arith}, variables)
+        except Exception:
+            # 未定义变量、类型不匹配等情况交给 JS 引擎，保持 JS 的语义
+            return None
+
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, float) and value == int(value):
+            return str(int(value))
+        if isinstance(value, (str, int, float)):
+            return str(value)
+        return None
+
     def _replace_template_vars(self, template: str, variables: dict) -> str:
         """替换模板变量，支持 JS 表达式
 
@@ -198,9 +397,12 @@ class TuneHubClient:
             result = result.replace(f"{{{{{key}}}}}", str(value))
             result = result.replace(f"{{{key}}}", str(value))
 
+        # 绝大多数模板在简单替换后已没有表达式，直接返回
+        if "{{" not in result:
+            return result
+
         # 第二步：处理 JS 表达式 {{expr}}
-        # 匹配 {{expr}} 模式，使用 execjs 安全地计算表达式
-        pattern = r'\{\{([^}]+)\}\}'
+        # 匹配 {{expr}} 模式，简单表达式在 Python 中计算，其余使用 execjs
 
         def replace_js_expr(match):
             js_expr = match.group(1).strip()
@@ -213,15 +415,20 @@ class TuneHubClient:
                            'process.', 'child_process', 'fs.', 'http.', 'https.']
                 for d in dangerous:
                     if d.lower() in js_expr.lower():
-                        logger.warning(f"JS 表达式包含危险内容: {d}")
+                        logger.warning("JS 表达式包含危险内容: %s", d)
                         return match.group(0)
 
+                # 常见的默认值和算术表达式直接在 Python 中计算，避免启动 JS 运行时
+                value = self._eval_expr(js_expr, variables)
+                if value is not None:
+                    return value
+
                 # 构建 JavaScript 代码来计算表达式
                 # 创建变量环境
                 js_vars = []
                 for key, value in variables.items():
                     # JavaScript 变量名只能是字母、数字、下划线、$
-                    safe_key = re.sub(r'[^a-zA-Z_$]', '_', key)
+                    safe_key = _UNSAFE_JS_IDENT.sub('_', key)
                     if isinstance(value, str):
                         js_vars.append(f"var {safe_key} = '{value}';")
                     elif isinstance(value, bool):
@@ -243,19 +450,31 @@ class TuneHubClient:
                 return str(int(result_value) if isinstance(result_value, float) and result_value == int(result_value) else result_value)
 
             except Exception as e:
-                logger.warning(f"计算 JS 表达式失败: {js_expr}, error: {e}")
+                logger.warning("计算 JS 表达式失败: %s, error: %s", js_expr, e)
                 return match.group(0)
 
-        result = re.sub(pattern, replace_js_expr, result)
+        result = _TEMPLATE_EXPR.sub(replace_js_expr, result)
         return result
 
-    def _execute_transform(self, transform_func: str, response_data: dict) -> list:
-        """执行 JS transform 函数"""
-        import json
-        import subprocess
-        import tempfile
-        import os
+    def _prepare_transform(self, transform_func: str) -> Optional[str]:
+        """校验 transform 函数并提取函数体，结果按源码哈希缓存
 
+        Returns:
+            函数体（含花括号），包含危险内容或格式错误时返回 None
+        """
+        key = hashlib.blake2b(transform_func.encode(), digest_size=16).hexdigest()
+        if key in self._transform_cache:
+            return self._transform_cache[key]
+
+        body = self._extract_transform_body(transform_func)
+        if len(self._transform_cache) >= TRANSFORM_CACHE_SIZE:
+            self._transform_cache.clear()
+        self._transform_cache[key] = body
+        return body
+
+    @staticmethod
+    def _extract_transform_body(transform_func: str) -> Optional[str]:
+        """校验 transform 函数并提取函数体"""
         # 安全检查：验证 transform 函数不包含危险操作
         dangerous_patterns = [
             'eval(', 'setTimeout(', 'setInterval(',
@@ -265,34 +484,45 @@ class TuneHubClient:
 
         for pattern in dangerous_patterns:
             if pattern.lower() in transform_func.lower():
-                logger.warning(f"Transform 函数包含危险内容: {pattern}")
-                return []
+                logger.warning("Transform 函数包含危险内容: %s", pattern)
+                return None
+
+        # 提取函数体
+        func_body = transform_func.strip()
+        paren_start = func_body.find('(')
+        if paren_start == -1:
+            logger.warning("Transform 函数格式错误")
+            return None
 
-        try:
-            # 提取函数体
-            func_body = transform_func.strip()
-            paren_start = func_body.find('(')
-            if paren_start == -1:
-                logger.warning(f"Transform 函数格式错误")
-                return []
+        brace_start = func_body.find('{', paren_start)
+        if brace_start == -1:
+            logger.warning("Transform 函数格式错误")
+            return None
 
-            brace_start = func_body.find('{', paren_start)
-            if brace_start == -1:
-                logger.warning(f"Transform 函数格式错误")
-                return []
+        # 找到匹配的结束括号
+        brace_count = 1
+        body_end = brace_start + 1
+        while brace_count > 0 and body_end < len(func_body):
+            if func_body[body_end] == '{':
+                brace_count += 1
+            elif func_body[body_end] == '}':
+                brace_count -= 1
+            body_end += 1
 
-            # 找到匹配的结束括号
-            brace_count = 1
-            body_end = brace_start + 1
-            while brace_count > 0 and body_end < len(func_body):
-                if func_body[body_end] == '{':
-                    brace_count += 1
-                elif func_body[body_end] == '}':
-                    brace_count -= 1
-                body_end += 1
+        return func_body[brace_start:body_end]
 
-            actual_body = func_body[brace_start:body_end]
-            json_data = json.dumps(response_data)
+    def _execute_transform(self, transform_func: str, response_data: dict) -> list:
+        """执行 JS transform 函数"""
+        import subprocess
+        import tempfile
+        import os
+
+        actual_body = self._prepare_transform(transform_func)
+        if actual_body is None:
+            return []
+
+        try:
+            json_data = _dumps(response_data).decode()
 
             # 构建 Node.js 脚本
             js_script = f"const data = {json_data};\nconst result = (function(response) {{ {actual_body} }})(data);\nconsole.log(JSON.stringify(result));"
@@ -311,7 +541,7 @@ class TuneHubClient:
 
                 if result.returncode != 0:
                     stderr = result.stderr.decode('utf-8', errors='replace') if result.stderr else ''
-                    logger.warning(f"Node.js 执行失败: {stderr}")
+                    logger.warning("Node.js 执行失败: %s", stderr)
                     return []
 
                 if not result.stdout:
@@ -323,8 +553,8 @@ class TuneHubClient:
                     logger.warning("Node.js 输出为空")
                     return []
 
-                parsed = json.loads(output)
-                logger.debug(f"Transform 执行成功，返回 {len(parsed) if isinstance(parsed, list) else 'non-list'} 条")
+                parsed = _loads(output)
+                logger.debug("Transform 执行成功，返回 %s 条", len(parsed) if isinstance(parsed, list) else "non-list")
                 return parsed if isinstance(parsed, list) else []
 
             finally:
@@ -333,11 +563,11 @@ class TuneHubClient:
         except subprocess.TimeoutExpired:
             logger.warning("Node.js 执行超时")
             return []
-        except json.JSONDecodeError as e:
-            logger.warning(f"JSON 解析失败: {e}")
+        except orjson.JSONDecodeError as e:
+            logger.warning("JSON 解析失败: %s", e)
             return []
         except Exception as e:
-            logger.warning(f"执行 transform 失败: {e}")
+            logger.warning("执行 transform 失败: %s", e)
             return []
 
     async def execute_method(
@@ -358,7 +588,7 @@ class TuneHubClient:
             # 构建 URL（替换模板变量）
             url = config.get("url", "")
             url = self._replace_template_vars(url, variables)
-            logger.debug(f"构建 URL: {url}")
+            logger.debug("构建 URL: %s", url)
 
             # 构建查询参数
             params = {}
@@ -366,16 +596,16 @@ class TuneHubClient:
                 if isinstance(value, str):
                     processed_value = self._replace_template_vars(value, variables)
                     params[key] = processed_value
-                    logger.debug(f"参数 {key}: {value} -> {processed_value}")
+                    logger.debug("参数 %s: %s -> %s", key, value, processed_value)
                 else:
                     params[key] = value
 
-            logger.debug(f"参数处理完成，共 {len(params)} 个参数")
+            logger.debug("参数处理完成，共 %d 个参数", len(params))
 
             headers = config.get("headers", {})
             method = config.get("method", "GET")
 
-            logger.debug(f"最终请求: {method} {url} params={params}")
+            logger.debug("最终请求: %s %s params=%s", method, url, params)
 
             session = await self._get_session()
 
@@ -387,11 +617,22 @@ class TuneHubClient:
                 # 替换 body 中的模板变量
                 if isinstance(body, dict):
                     body = {k: self._replace_template_vars(str(v), variables) if isinstance(v, str) else v for k, v in body.items()}
-                resp = await session.request(method, url, json=body, params=params, headers=headers)
-
-            # 强制解析 JSON（某些 API 返回 text/plain）
-            response_data = await resp.json(content_type=None)
-            logger.debug(f"API 原始响应类型: {type(response_data).__name__}, 键: {list(response_data.keys()) if isinstance(response_data, dict) else 'N/A'}")
+                if isinstance(body, (dict, list)):
+                    resp = await session.request(
+                        method, url, data=_dumps(body), params=params,
+                        headers={"Content-Type": "application/json", **headers}
+                    )
+                else:
+                    resp = await session.request(method, url, json=body, params=params, headers=headers)
+
+            # 强制解析 JSON（某些 API 返回 text/plain）；第三方接口的编码不固定，由 aiohttp 按 charset 解码
+            response_data = await resp.json(content_type=None, loads=_loads)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "API 原始响应类型: %s, 键: %s",
+                    type(response_data).__name__,
+                    list(response_data.keys()) if isinstance(response_data, dict) else "N/A"
+                )
 
             # 检查 API 错误响应（仅当存在明确的错误码时才判定为错误）
             # 不同 API 使用不同的成功码：code=0, code=200, 或无 code 字段
@@ -399,21 +640,22 @@ class TuneHubClient:
                 code = response_data.get("code")
                 # 常见的错误码：400, 401, 403, 404, 500, 502, 503 等
                 if code is not None and code >= 400:
-                    logger.warning(f"API 返回错误: code={code}, msg={response_data.get('msg', '未知错误')}")
+                    logger.warning("API 返回错误: code=%s, msg=%s", code, response_data.get("msg", "未知错误"))
                     return []
 
             # 执行 transform 转换
             transform_func = config.get("transform", "")
             if transform_func:
-                result = self._execute_transform(transform_func, response_data)
+                # transform 会启动 Node.js 子进程，放到线程中执行以免阻塞其他平台的请求
+                result = await asyncio.to_thread(self._execute_transform, transform_func, response_data)
                 if not result:
-                    logger.warning(f"Transform 返回空结果，原始数据前200字符: {str(response_data)[:200]}")
+                    logger.warning("Transform 返回空结果，原始数据前200字符: %s", str(response_data)[:200])
                 return result
 
             return response_data if isinstance(response_data, list) else []
 
         except Exception as e:
-            logger.warning(f"执行方法失败: {e}")
+            logger.warning("执行方法失败: %s", e)
             return []
 
     # ==================== 搜索功能 ====================
@@ -426,10 +668,10 @@ class TuneHubClient:
         limit: int = 20
     ) -> list[SearchResult]:
         """搜索歌曲"""
-        logger.debug(f"搜索: platform={platform}, keyword={keyword}")
+        logger.debug("搜索: platform=%s, keyword=%s", platform, keyword)
         config = await self.get_method_config(platform, "search")
         if not config:
-            logger.warning(f"未获取到 {platform} 搜索配置")
+            logger.warning("未获取到 %s 搜索配置", platform)
             return []
 
         results = await self.execute_method(config, {
@@ -437,54 +679,98 @@ class TuneHubClient:
             "page": page,
             "limit": limit
         })
-        logger.debug(f"搜索结果: {platform} 返回 {len(results)} 条")
+        logger.debug("搜索结果: %s 返回 %d 条", platform, len(results))
 
         # 字段映射
-        songs = []
-        for r in results:
-            songs.append(SearchResult(
+        return [
+            SearchResult(
                 id=str(r.get("id", "")),
                 name=r.get("name", ""),
                 artist=r.get("artist", ""),
                 album=r.get("album", ""),
                 platform=platform
-            ))
-        return songs
+            )
+            for r in results
+        ]
 
-    async def aggregate_search(self, keyword: str) -> list[SearchResult]:
-        """聚合搜索（并发搜索所有平台）"""
-        tasks = []
-        platforms = list(PLATFORMS.keys())
-        logger.info(f"聚合搜索: keyword={keyword}, platforms={platforms}")
-        for platform in platforms:
-            tasks.append(self.search(platform, keyword))
+    async def _guarded_search(self, platform: str, keyword: str, limit: int) -> list[SearchResult]:
+        """在并发限制内搜索单个平台"""
+        async with self._search_sem:
+            return await self.search(platform, keyword, limit=limit)
 
-        platform_results = await asyncio.gather(*tasks, return_exceptions=True)
+    async def multi_search(
+        self,
+        keyword: str,
+        sources: Optional[list[str]] = None,
+        limit: int = 20,
+        timeout: float = SEARCH_TIMEOUT
+    ) -> dict[str, list[SearchResult]]:
+        """并发搜索多个平台
 
-        all_results = []
-        for platform, results in zip(platforms, platform_results):
-            if isinstance(results, Exception):
-                logger.warning(f"搜索 {platform} 失败: {results}")
-                continue
+        超过 timeout 秒仍未返回或搜索失败的平台不会出现在返回结果中。
+
+        Returns:
+            平台 -> 搜索结果列表
+        """
+        sources = sources or list(PLATFORMS)
+        tasks = [asyncio.ensure_future(self._guarded_search(source, keyword, limit)) for source in sources]
+
+        # 慢平台超时后放弃，不拖慢整体结果
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+        results = {}
+        for source, task in zip(sources, tasks):
+            if task in pending:
+                logger.warning("搜索 %s 失败: 超时 (%ss)", source, timeout)
+            elif task.exception():
+                logger.warning("搜索 %s 失败: %s", source, task.exception())
+            else:
+                results[source] = task.result()
+        return results
+
+    async def aggregate_search(self, keyword: str, timeout: float = SEARCH_TIMEOUT) -> list[SearchResult]:
+        """聚合搜索（并发搜索所有平台，结果按规范化关键词短时缓存）
+
+        超过 timeout 秒仍未返回的平台会被放弃，仅返回已完成平台的结果。
+        """
+        keyword = keyword.strip()
+        cache_key = keyword.casefold()
+        cached = self._search_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("搜索缓存命中: %s", keyword)
+            return cached
+
+        platforms = list(PLATFORMS.keys())
+        logger.info("聚合搜索: keyword=%s, platforms=%s", keyword, platforms)
+        platform_results = await self.multi_search(keyword, platforms, timeout=timeout)
+        complete = len(platform_results) == len(platforms)
+
+        # 去重（按 platform + id，保留第一个匹配）；search() 已为每条结果标注平台
+        seen: set[tuple[str, str]] = set()
+        unique_results: list[SearchResult] = []
+        for platform, results in platform_results.items():
             for r in results:
-                r.platform = platform
-                all_results.append(r)
-
-        # 去重（按 platform + id，保留第一个匹配）
-        seen = {}
-        unique_results = []
-        for r in all_results:
-            key = (r.platform, r.id)
-            if key not in seen:
-                seen[key] = True
+                key = (platform, r.id)
+                if key in seen:
+                    continue
+                seen.add(key)
                 unique_results.append(r)
 
+        # 部分平台失败或超时的结果不缓存
+        if unique_results and complete:
+            self._search_cache.set(cache_key, unique_results)
         return unique_results
 
     # ==================== 排行榜功能 ====================
 
     async def get_toplists(self, platform: str) -> list[ToplistItem]:
-        """获取排行榜列表"""
+        """获取排行榜列表，结果短时缓存"""
+        cached = self._toplist_cache.get(platform)
+        if cached is not None:
+            return cached
+
         config = await self.get_method_config(platform, "toplists")
         if not config:
             return []
@@ -492,39 +778,46 @@ class TuneHubClient:
         results = await self.execute_method(config, {})
 
         # 字段名映射：API 返回 camelCase，dataclass 使用 snake_case
-        toplists = []
-        for r in results:
-            toplists.append(ToplistItem(
+        toplists = [
+            ToplistItem(
                 id=r.get("id", ""),
                 name=r.get("name", ""),
                 pic=r.get("pic", ""),
                 update_frequency=r.get("updateFrequency", r.get("update_frequency", ""))
-            ))
+            )
+            for r in results
+        ]
+        if toplists:
+            self._toplist_cache.set(platform, toplists)
         return toplists
 
     async def get_toplist_songs(self, platform: str, list_id: str) -> list[SearchResult]:
-        """获取榜单歌曲"""
+        """获取榜单歌曲，结果短时缓存"""
+        cache_key = (platform, list_id)
+        cached = self._toplist_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         config = await self.get_method_config(platform, "toplist")
         if not config:
             return []
 
-        # 替换 URL 中的 id 占位符
-        url = config.get("url", "")
-        url = url.replace("{{id}}", list_id).replace("{id}", list_id)
-        config["url"] = url
-
+        # URL 中的 id 占位符由 execute_method 替换，不能改写缓存的配置
         results = await self.execute_method(config, {"id": list_id})
 
         # 字段映射
-        songs = []
-        for r in results:
-            songs.append(SearchResult(
+        songs = [
+            SearchResult(
                 id=str(r.get("id", "")),
                 name=r.get("name", ""),
                 artist=r.get("artist", ""),
                 album=r.get("album", ""),
                 platform=platform
-            ))
+            )
+            for r in results
+        ]
+        if songs:
+            self._toplist_cache.set(cache_key, songs)
         return songs
 
     # ==================== 歌单功能 ====================
@@ -535,11 +828,7 @@ class TuneHubClient:
         if not config:
             return {}
 
-        # 替换 URL 中的 id 占位符
-        url = config.get("url", "")
-        url = url.replace("{{id}}", playlist_id).replace("{id}", playlist_id)
-        config["url"] = url
-
+        # URL 中的 id 占位符由 execute_method 替换，不能改写缓存的配置
         result = await self.execute_method(config, {"id": playlist_id})
 
         return result if result else {}
@@ -547,93 +836,116 @@ class TuneHubClient:
     # ==================== 下载功能 ====================
 
     async def download_bytes(self, url: str) -> bytes:
-        """下载通用内容（封面等）"""
+        """下载通用内容（封面等），结果按 URL 缓存"""
+        cached = self._cover_cache.get(url)
+        if cached is not None:
+            return cached
+
         try:
-            session = await self._get_session()
-            async with session.get(url) as resp:
+            session = await self._get_download_session()
+            async with session.get(url, timeout=CDN_TIMEOUT) as resp:
                 if resp.status == 200:
-                    return await resp.read()
+                    data = await resp.read()
+                    self._cover_cache.set(url, data)
+                    return data
                 return b""
         except Exception as e:
-            logger.warning(f"下载失败: {e}")
+            logger.warning("下载失败: %s", e)
             return b""
 
     async def download_audio(
         self,
         url: str,
+        sink: BinaryIO,
         progress_callback=None,
         max_retries: int = 3,
         timeout: int = 180
-    ) -> bytes:
-        """下载音频内容，支持进度回调和自动重试
+    ) -> int:
+        """下载音频内容并流式写入 sink，支持进度回调和自动重试
 
         Args:
             url: 音频 URL
+            sink: 可写的二进制文件对象，分块写入，内存占用与文件大小无关
             progress_callback: 可选的进度回调函数 async def callback(downloaded, total)
             max_retries: 最大重试次数
             timeout: 下载超时时间（秒）
+
+        Returns:
+            写入的字节数，失败返回 0
         """
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
-        if "kuwo" in url.lower():
-            headers["Referer"] = "https://www.kuwo.cn/"
-        elif "kugou" in url.lower():
-            headers["Referer"] = "https://www.kugou.com/"
+        headers = DOWNLOAD_HEADERS.copy()
+        host = yarl.URL(url).host or ""
+        for suffix, referer in _REFERERS.items():
+            if host.endswith(suffix):
+                headers["Referer"] = referer
+                break
+
+        # 所有重试共用同一个下载 Session 和超时设置，重试时复用已建立的连接
+        download_session = await self._get_download_session()
+        download_timeout = aiohttp.ClientTimeout(total=timeout, connect=30)
 
         for attempt in range(1, max_retries + 1):
             try:
-                logger.debug(f"开始下载 (尝试 {attempt}/{max_retries}): {url[:100]}...")
-
-                download_timeout = aiohttp.ClientTimeout(total=timeout, connect=30)
-                async with aiohttp.ClientSession(timeout=download_timeout) as download_session:
-                    async with download_session.get(url, headers=headers) as resp:
-                        if resp.status != 200:
-                            logger.warning(f"下载失败: HTTP {resp.status}")
-                            if attempt < max_retries:
-                                await asyncio.sleep(2)
-                                continue
-                            return b""
-
-                        total = int(resp.headers.get("Content-Length", 0))
-                        logger.debug(f"文件大小: {total} bytes")
-                        downloaded = 0
-                        chunks = []
-
-                        async for chunk in resp.content.iter_chunked(64 * 1024):
-                            chunks.append(chunk)
-                            downloaded += len(chunk)
-                            if progress_callback and total > 0:
-                                await progress_callback(downloaded, total)
-
-                        result = b"".join(chunks)
-                        logger.debug(f"下载完成: {len(result)} bytes")
-                        return result
+                logger.debug("开始下载 (尝试 %d/%d): %.100s...", attempt, max_retries, url)
+                # 重试时丢弃上一次写入的部分内容
+                sink.seek(0)
+                sink.truncate()
+
+                async with download_session.get(url, headers=headers, timeout=download_timeout) as resp:
+                    if resp.status != 200:
+                        logger.warning("下载失败: HTTP %s", resp.status)
+                        # 客户端错误（超时/限流除外）重试也无济于事
+                        if 400 <= resp.status < 500 and resp.status not in RETRYABLE_CLIENT_STATUSES:
+                            return 0
+                        if attempt < max_retries:
+                            await asyncio.sleep(_retry_delay(attempt, resp.headers.get("Retry-After")))
+                            continue
+                        return 0
+
+                    total = resp.content_length or 0
+                    logger.debug("文件大小: %d bytes", total)
+                    downloaded = 0
+                    last_reported = 0
+                    report_progress = progress_callback is not None and total > 0
+
+                    # iter_any 直接返回已到达的数据，不做固定大小的重新分块
+                    async for chunk in resp.content.iter_any():
+                        sink.write(chunk)
+                        downloaded += len(chunk)
+                        if report_progress and downloaded - last_reported >= PROGRESS_CALLBACK_BYTES:
+                            last_reported = downloaded
+                            await progress_callback(downloaded, total)
+
+                    if report_progress and downloaded != last_reported:
+                        await progress_callback(downloaded, total)
+
+                    sink.flush()
+                    logger.debug("下载完成: %d bytes", downloaded)
+                    return downloaded
 
             except asyncio.TimeoutError:
-                logger.warning(f"下载超时 (尝试 {attempt}/{max_retries})")
+                logger.warning("下载超时 (尝试 %d/%d)", attempt, max_retries)
                 if attempt < max_retries:
-                    await asyncio.sleep(2)
+                    await asyncio.sleep(_retry_delay(attempt))
                     continue
-                return b""
+                return 0
             except Exception as e:
-                logger.warning(f"下载失败 (尝试 {attempt}/{max_retries}): {type(e).__name__}: {e}")
+                logger.warning("下载失败 (尝试 %d/%d): %s: %s", attempt, max_retries, type(e).__name__, e)
                 if attempt < max_retries:
-                    await asyncio.sleep(2)
+                    await asyncio.sleep(_retry_delay(attempt))
                     continue
-                return b""
+                return 0
 
-        return b""
+        return 0
 
     async def get_file_size(self, url: str) -> int:
         """获取文件大小"""
         try:
-            session = await self._get_session()
-            async with session.head(url, allow_redirects=True) as resp:
-                length = resp.headers.get("Content-Length", "0")
-                return int(length)
+            session = await self._get_download_session()
+            async with session.head(url, allow_redirects=True, timeout=CDN_TIMEOUT) as resp:
+                return resp.content_length or 0
         except Exception as e:
-            logger.warning(f"获取文件大小失败: {e}")
+            logger.warning("获取文件大小失败: %s", e)
             return 0
 
 
@@ -1,106 +1,183 @@
 """TuneBot 数据库模块 - 收藏夹与历史记录"""
+import asyncio
+import time
+from collections import OrderedDict
+
 import aiosqlite
-from pathlib import Path
-from datetime import datetime
 from typing import Optional
 
 from config import DB_PATH
 
+# 进程内共享的数据库连接（aiosqlite 在单独线程中串行执行语句）
+_db: Optional[aiosqlite.Connection] = None
+_connect_lock = asyncio.Lock()
+# 写操作锁：保证每次写入与提交作为一个整体执行，不与其他协程的写入交错
+_db_lock = asyncio.Lock()
+
+# 用户偏好的进程内 LRU 缓存：user_id -> 音质（None 表示未设置）
+USER_PREFS_CACHE_SIZE = 4096
+_user_quality_cache: OrderedDict[int, Optional[str]] = OrderedDict()
+
+
+async def _get_db() -> aiosqlite.Connection:
+    """获取进程内共享的数据库连接，首次调用时打开并调优"""
+    global _db
+    if _db is not None:
+        return _db
+    async with _connect_lock:
+        if _db is None:
+            DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+            db = await aiosqlite.connect(DB_PATH)
+            db.row_factory = aiosqlite.Row
+            # 启用 WAL 模式，读写互不阻塞
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=NORMAL")  # 平衡性能和数据安全
+            await db.execute("PRAGMA cache_size=-65536")  # 64MB 页缓存
+            await db.execute("PRAGMA mmap_size=268435456")  # 256MB 内存映射
+            await db.execute("PRAGMA temp_store=MEMORY")  # 临时表和排序使用内存
+            _db = db
+    return _db
+
+
+async def close_db():
+    """关闭共享数据库连接"""
+    global _db
+    if _db is not None:
+        await _db.close()
+        _db = None
+
 
 async def init_db():
     """初始化数据库表"""
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    async with aiosqlite.connect(DB_PATH, isolation_level=None) as db:
-        # 启用 WAL 模式，提升并发性能
-        await db.execute("PRAGMA journal_mode=WAL")
-        await db.execute("PRAGMA synchronous=NORMAL")  # 平衡性能和数据安全
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS favorites (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                source TEXT NOT NULL,
-                song_id TEXT NOT NULL,
-                name TEXT,
-                artist TEXT,
-                album TEXT,
-                added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(source, song_id)
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                source TEXT NOT NULL,
-                song_id TEXT NOT NULL,
-                name TEXT,
-                artist TEXT,
-                album TEXT,
-                quality TEXT,
-                file_id TEXT,
-                downloaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE INDEX IF NOT EXISTS idx_history_downloaded
-            ON history(downloaded_at DESC)
-        """)
-        await db.commit()
+    db = await _get_db()
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS favorites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT NOT NULL,
+            song_id TEXT NOT NULL,
+            name TEXT,
+            artist TEXT,
+            album TEXT,
+            added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(source, song_id)
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT NOT NULL,
+            song_id TEXT NOT NULL,
+            name TEXT,
+            artist TEXT,
+            album TEXT,
+            quality TEXT,
+            file_id TEXT,
+            downloaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_prefs (
+            user_id INTEGER PRIMARY KEY,
+            quality TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS method_cache (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            expires_at INTEGER NOT NULL
+        )
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_history_downloaded
+        ON history(downloaded_at DESC)
+    """)
+    # 部分索引与 find_history_by_song 的过滤和排序完全匹配，取代旧的 idx_history_song
+    await db.execute("DROP INDEX IF EXISTS idx_history_song")
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_history_song_file
+        ON history(source, song_id, downloaded_at DESC)
+        WHERE file_id IS NOT NULL AND file_id != ''
+    """)
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_fav_added
+        ON favorites(added_at DESC)
+    """)
+    await db.commit()
 
 
 # ==================== 收藏夹操作 ====================
 
 async def add_favorite(source: str, song_id: str, name: str, artist: str, album: str = "") -> bool:
     """添加收藏，返回是否成功"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        try:
-            await db.execute(
+    db = await _get_db()
+    try:
+        async with _db_lock:
+            cursor = await db.execute(
                 "INSERT OR IGNORE INTO favorites (source, song_id, name, artist, album) VALUES (?, ?, ?, ?, ?)",
                 (source, song_id, name, artist, album)
             )
             await db.commit()
-            return db.total_changes > 0
-        except Exception:
-            return False
+        return cursor.rowcount > 0
+    except Exception:
+        return False
 
 
 async def remove_favorite(source: str, song_id: str) -> bool:
     """移除收藏"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    db = await _get_db()
+    async with _db_lock:
+        cursor = await db.execute(
             "DELETE FROM favorites WHERE source = ? AND song_id = ?",
             (source, song_id)
         )
         await db.commit()
-        return db.total_changes > 0
+    return cursor.rowcount > 0
 
 
 async def is_favorite(source: str, song_id: str) -> bool:
     """检查是否已收藏"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT 1 FROM favorites WHERE source = ? AND song_id = ?",
-            (source, song_id)
-        )
-        return await cursor.fetchone() is not None
+    db = await _get_db()
+    cursor = await db.execute(
+        "SELECT 1 FROM favorites WHERE source = ? AND song_id = ?",
+        (source, song_id)
+    )
+    return await cursor.fetchone() is not None
+
+
+async def favorites_lookup(pairs) -> set[tuple[str, str]]:
+    """批量检查收藏状态，返回已收藏的 (source, song_id) 集合（单次查询）"""
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return set()
+    placeholders = ", ".join("(?, ?)" for _ in pairs)
+    params = [value for pair in pairs for value in pair]
+    db = await _get_db()
+    cursor = await db.execute(
+        f"SELECT source, song_id FROM favorites WHERE (source, song_id) IN (VALUES {placeholders})",
+        params
+    )
+    rows = await cursor.fetchall()
+    return {(row[0], row[1]) for row in rows}
 
 
 async def get_favorites(limit: int = 20, offset: int = 0) -> list[dict]:
     """获取收藏列表"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM favorites ORDER BY added_at DESC LIMIT ? OFFSET ?",
-            (limit, offset)
-        )
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+    db = await _get_db()
+    cursor = await db.execute(
+        "SELECT * FROM favorites ORDER BY added_at DESC LIMIT ? OFFSET ?",
+        (limit, offset)
+    )
+    rows = await cursor.fetchall()
+    return [dict(row) for row in rows]
 
 
 async def get_favorites_count() -> int:
     """获取收藏总数"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM favorites")
-        row = await cursor.fetchone()
-        return row[0] if row else 0
+    db = await _get_db()
+    cursor = await db.execute("SELECT COUNT(*) FROM favorites")
+    row = await cursor.fetchone()
+    return row[0] if row else 0
 
 
 # ==================== 历史记录操作 ====================
@@ -115,57 +192,119 @@ async def add_history(
     file_id: str = ""
 ) -> int:
     """添加历史记录，返回记录ID"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    db = await _get_db()
+    async with _db_lock:
         cursor = await db.execute(
             """INSERT INTO history (source, song_id, name, artist, album, quality, file_id)
                VALUES (?, ?, ?, ?, ?, ?, ?)""",
             (source, song_id, name, artist, album, quality, file_id)
         )
         await db.commit()
-        return cursor.lastrowid or 0
+    return cursor.lastrowid or 0
 
 
 async def get_history(limit: int = 20, offset: int = 0) -> list[dict]:
     """获取历史记录"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM history ORDER BY downloaded_at DESC LIMIT ? OFFSET ?",
-            (limit, offset)
-        )
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+    db = await _get_db()
+    cursor = await db.execute(
+        "SELECT * FROM history ORDER BY downloaded_at DESC LIMIT ? OFFSET ?",
+        (limit, offset)
+    )
+    rows = await cursor.fetchall()
+    return [dict(row) for row in rows]
 
 
 async def get_history_count() -> int:
     """获取历史总数"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM history")
-        row = await cursor.fetchone()
-        return row[0] if row else 0
+    db = await _get_db()
+    cursor = await db.execute("SELECT COUNT(*) FROM history")
+    row = await cursor.fetchone()
+    return row[0] if row else 0
 
 
 async def find_history_by_song(source: str, song_id: str) -> Optional[dict]:
     """查找歌曲的历史记录（用于 file_id 复用）"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            """SELECT * FROM history
-               WHERE source = ? AND song_id = ? AND file_id IS NOT NULL AND file_id != ''
-               ORDER BY downloaded_at DESC LIMIT 1""",
-            (source, song_id)
-        )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+    db = await _get_db()
+    cursor = await db.execute(
+        """SELECT * FROM history
+           WHERE source = ? AND song_id = ? AND file_id IS NOT NULL AND file_id != ''
+           ORDER BY downloaded_at DESC LIMIT 1""",
+        (source, song_id)
+    )
+    row = await cursor.fetchone()
+    return dict(row) if row else None
 
 
 async def get_history_by_id(history_id: int) -> Optional[dict]:
     """根据 ID 获取历史记录"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM history WHERE id = ?",
-            (history_id,)
+    db = await _get_db()
+    cursor = await db.execute(
+        "SELECT * FROM history WHERE id = ?",
+        (history_id,)
+    )
+    row = await cursor.fetchone()
+    return dict(row) if row else None
+
+
+# ==================== 用户偏好 ====================
+
+def _cache_user_quality(user_id: int, quality: Optional[str]):
+    """写入用户音质缓存，超出容量时淘汰最久未使用的项"""
+    _user_quality_cache[user_id] = quality
+    _user_quality_cache.move_to_end(user_id)
+    while len(_user_quality_cache) > USER_PREFS_CACHE_SIZE:
+        _user_quality_cache.popitem(last=False)
+
+
+async def get_user_quality(user_id: int) -> Optional[str]:
+    """获取用户设置的音质，未设置返回 None"""
+    if user_id in _user_quality_cache:
+        _user_quality_cache.move_to_end(user_id)
+        return _user_quality_cache[user_id]
+
+    db = await _get_db()
+    cursor = await db.execute(
+        "SELECT quality FROM user_prefs WHERE user_id = ?",
+        (user_id,)
+    )
+    row = await cursor.fetchone()
+    quality = row[0] if row else None
+    _cache_user_quality(user_id, quality)
+    return quality
+
+
+async def set_user_quality(user_id: int, quality: str):
+    """保存用户音质设置（同时更新缓存）"""
+    db = await _get_db()
+    async with _db_lock:
+        await db.execute(
+            """INSERT INTO user_prefs (user_id, quality) VALUES (?, ?)
+               ON CONFLICT(user_id) DO UPDATE SET quality = excluded.quality""",
+            (user_id, quality)
         )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+        await db.commit()
+    _cache_user_quality(user_id, quality)
+
+
+# ==================== 方法配置缓存 ====================
+
+async def get_cached_method(key: str) -> Optional[bytes]:
+    """读取未过期的方法配置缓存（JSON 字节）"""
+    db = await _get_db()
+    cursor = await db.execute(
+        "SELECT value FROM method_cache WHERE key = ? AND expires_at > ?",
+        (key, int(time.time()))
+    )
+    row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def set_cached_method(key: str, value: bytes, ttl: int):
+    """写入方法配置缓存"""
+    db = await _get_db()
+    async with _db_lock:
+        await db.execute(
+            "INSERT OR REPLACE INTO method_cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, int(time.time()) + ttl)
+        )
+        await db.commit()
@@ -2,15 +2,28 @@
 import re
 from config import PLATFORMS
 
+# 多歌手分隔符：、/ , & feat. ft.
+_ARTIST_SPLIT = re.compile(r'[、/,&]|feat\.|ft\.', re.IGNORECASE)
+
+# hashtag 中需要移除的字符：保留字母、数字和中文，去掉下划线
+_HASHTAG_STRIP = re.compile(r'[^\w\u4e00-\u9fff]|_')
+
+# 文件大小单位
+_KB = 1024
+_MB = 1024 * 1024
+
+# Markdown 特殊字符转义表
+_MD_ESCAPE = str.maketrans({c: f"\\{c}" for c in "_*[]()~`>#+-=|{}.!"})
+
 
 def format_file_size(size_bytes: int) -> str:
     """格式化文件大小"""
-    if size_bytes < 1024:
+    if size_bytes < _KB:
         return f"{size_bytes}B"
-    elif size_bytes < 1024 * 1024:
-        return f"{size_bytes / 1024:.1f}KB"
+    elif size_bytes < _MB:
+        return f"{size_bytes / _KB:.1f}KB"
     else:
-        return f"{size_bytes / (1024 * 1024):.1f}MB"
+        return f"{size_bytes / _MB:.1f}MB"
 
 
 def format_platform(source: str) -> str:
@@ -28,33 +41,38 @@ def format_song_caption(
     source_switched: str = ""
 ) -> str:
     """格式化歌曲消息 caption"""
-    lines = [f"🎵 {name} - {artist}"]
-
-    if album:
-        lines.append(f"💿 {album}")
-
-    meta_parts = []
-    if quality:
-        meta_parts.append(f"🎧 {quality}")
-    if size_bytes:
-        meta_parts.append(f"📦 {format_file_size(size_bytes)}")
-    if meta_parts:
-        lines.append(" | ".join(meta_parts))
+    album_line = f"\n💿 {album}" if album else ""
+
+    if quality and size_bytes:
+        meta_line = f"\n🎧 {quality} | 📦 {format_file_size(size_bytes)}"
+    elif quality:
+        meta_line = f"\n🎧 {quality}"
+    elif size_bytes:
+        meta_line = f"\n📦 {format_file_size(size_bytes)}"
+    else:
+        meta_line = ""
 
     if source_switched:
-        lines.append(f"🔄 {source_switched}")
+        origin_line = f"\n🔄 {source_switched}"
     elif source:
-        lines.append(f"📍 {format_platform(source)}")
+        origin_line = f"\n📍 {format_platform(source)}"
+    else:
+        origin_line = ""
 
-    return "\n".join(lines)
+    return f"🎵 {name} - {artist}{album_line}{meta_line}{origin_line}"
 
 
 def format_search_result(result, index: int) -> str:
     """格式化搜索结果显示"""
     # 支持 SearchResult 对象和字典
-    name = getattr(result, 'name', None) or result.get("name", "未知") if hasattr(result, 'get') else "未知"
-    artist = getattr(result, 'artist', None) or result.get("artist", "未知") if hasattr(result, 'get') else "未知"
-    platform = getattr(result, 'platform', None) or result.get("platform", "") if hasattr(result, 'get') else ""
+    if isinstance(result, dict):
+        name = result.get("name") or "未知"
+        artist = result.get("artist") or "未知"
+        platform = result.get("platform", "")
+    else:
+        name = result.name or "未知"
+        artist = result.artist or "未知"
+        platform = result.platform
     return f"{index}. {name} - {artist} [{format_platform(platform)}]"
 
 
@@ -66,19 +84,24 @@ def format_favorite_item(item: dict, index: int) -> str:
     return f"{index}. {name} - {artist} [{source}]"
 
 
-def format_history_item(item: dict, index: int) -> str:
-    """格式化历史记录项"""
+def format_history_item(item: dict, index: int, is_fav: bool = False) -> str:
+    """格式化历史记录项（已收藏的歌曲带 ❤️ 标记）"""
     name = item.get("name", "未知")
     artist = item.get("artist", "未知")
     quality = item.get("quality", "")
-    return f"{index}. {name} - {artist} ({quality})"
+    fav_mark = " ❤️" if is_fav else ""
+    return f"{index}. {name} - {artist} ({quality}){fav_mark}"
 
 
-def format_toplist_item(item: dict, index: int) -> str:
+def format_toplist_item(item, index: int) -> str:
     """格式化排行榜项"""
     # 支持 ToplistItem 对象和字典
-    name = getattr(item, 'name', None) or item.get("name", "未知") if hasattr(item, 'get') else "未知"
-    update = getattr(item, 'update_frequency', None) or item.get("updateFrequency", "") if hasattr(item, 'get') else ""
+    if isinstance(item, dict):
+        name = item.get("name") or "未知"
+        update = item.get("updateFrequency", "")
+    else:
+        name = item.name or "未知"
+        update = item.update_frequency
     if update:
         return f"{index}. {name} ({update})"
     return f"{index}. {name}"
@@ -86,18 +109,12 @@ def format_toplist_item(item: dict, index: int) -> str:
 
 def escape_markdown(text: str) -> str:
     """转义 Markdown 特殊字符"""
-    chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for char in chars:
-        text = text.replace(char, f"\\{char}")
-    return text
+    return text.translate(_MD_ESCAPE)
 
 
 def make_hashtag(text: str) -> str:
     """生成单个 hashtag（移除空格和特殊字符，保留中文）"""
-    def is_cjk(char: str) -> bool:
-        """检查是否为 CJK 字符"""
-        return '\u4e00' <= char <= '\u9fff'
-    tag = "".join(c for c in text if c.isalnum() or is_cjk(c))
+    tag = _HASHTAG_STRIP.sub("", text)
     return f"#{tag}" if tag else ""
 
 
@@ -115,29 +132,27 @@ def make_hashtags(
     - 来源：#netease等
     """
     tags = []
+    seen = set()
+
+    def add_tag(tag: str):
+        if tag and len(tag) > 1 and tag not in seen:
+            seen.add(tag)
+            tags.append(tag)
 
     # 歌曲名标签
     if name:
-        name_tag = make_hashtag(name)
-        if name_tag and len(name_tag) > 1:
-            tags.append(name_tag)
+        add_tag(make_hashtag(name))
 
     # 歌手标签（支持多歌手分隔）
     if artist:
-        # 按常见分隔符拆分：、/ , & feat. ft.
-        artists = re.split(r'[、/,&]|feat\.|ft\.', artist, flags=re.IGNORECASE)
-        for a in artists:
+        for a in _ARTIST_SPLIT.split(artist):
             a = a.strip()
             if a:
-                artist_tag = make_hashtag(a)
-                if artist_tag and len(artist_tag) > 1 and artist_tag not in tags:
-                    tags.append(artist_tag)
+                add_tag(make_hashtag(a))
 
     # 专辑标签
     if album:
-        album_tag = make_hashtag(album)
-        if album_tag and len(album_tag) > 1 and album_tag not in tags:
-            tags.append(album_tag)
+        add_tag(make_hashtag(album))
 
     # 来源标签
     if source: